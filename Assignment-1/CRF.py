@@ -1,11 +1,66 @@
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
+import threading
+import pycrfsuite
+from profiling import profiled
+from tag_cache import TagCache, model_versions
+
+
+# Everything about one word which does not depend on where it is in the sentence:
+# features are its own features, context has the features it gives to the words around it
+# ('-1', '-2' and '+1' are the positions it is seen from). attributes and context_attributes
+# are the same in the {name: weight} form crfsuite uses.
+WordFeatures = namedtuple('WordFeatures', ['features', 'attributes', 'context', 'context_attributes'])
+
+CONTEXT_NAMES = {'-1': 'word_prev()', '-2': 'word_prev2()', '+1': 'word_fwd()'}
+
+# Change this whenever FeatureExtractor makes different features. It is part of the
+# hash saved feature stores are checked against (see feature_store.py)
+FEATURE_VERSION = 1
+
+# The training vocabulary is saved next to the model as sorted, lowercased words, one per line
+VOCABULARY_FILE = 'crf_pos_tagger_cv.vocab'
+
+# The Tagger and FeatureExtractor of the current pool worker, see CRFTaggerService
+worker = threading.local()
+
+
+class Vocabulary:
+    # The file is only read the first time a word is looked up, so creating a
+    # Vocabulary costs nothing and a worker which never tags never reads it
+    def __init__(self, filename=VOCABULARY_FILE):
+        self.filename = filename
+        self.words = None
+
+    def load(self):
+        if self.words is None:
+            with open(self.filename, encoding='utf-8') as inp:
+                self.words = frozenset(inp.read().split('\n'))
+        return self.words
+
+    def __contains__(self, word):
+        return word in self.load()
+
+    def __len__(self):
+        return len(self.load())
+
+
+def save_vocabulary(words, filename=VOCABULARY_FILE):
+    with open(filename, 'w', encoding='utf-8') as out:
+        out.write('\n'.join(sorted(words)))
+
+
 class FeatureExtractor:
-    def __init__(self, train_vocab):
+    # cache_size is the number of different words whose features are kept,
+    # the least recently used ones are dropped first
+    def __init__(self, train_vocab, cache_size=100000):
         self.train_vocab = train_vocab
+        #every instance has its own cache, it depends on train_vocab
+        self.word_features = lru_cache(maxsize=cache_size)(self.compute_word_features)
 
-    def word2features(self, sent, i):
-        #this function creates a features of the current word.
-        word = sent[i]  #current word
-
+    def compute_word_features(self, word):
         # Base features for the current word
         features = {
             'bias': 1.0,
@@ -28,53 +83,204 @@ class FeatureExtractor:
             'is_unknown': word.lower() not in self.train_vocab,
         }
 
+        # Features this word gives to the words next to it. The trained model has
+        # '-1:word.isdigit()' etc. with the isdigit() of the current word, so those
+        # are added by word2features and not here.
+        context = {}
+        for position, name in CONTEXT_NAMES.items():
+            context[position] = {
+                position + ':word.lower()': features['word.lower()'],
+                position + ':' + name: word,
+                position + ':word.istitle()': features['word.istitle()'],
+                position + ':word.isupper()': features['word.isupper()'],
+                position + ':word.islower()': features['word.islower()'],
+            }
+
+        context_attributes = {position: to_attributes(context_features) for position, context_features in context.items()}
+        return WordFeatures(features, to_attributes(features), context, context_attributes)
+
+    def word2features(self, sent, i):
+        #this function creates a features of the current word.
+        features = dict(self.word_features(sent[i]).features)
+        isdigit = features['word.isdigit()']
+
         # Features from the previous word
         if i > 0:
-            word_prev = sent[i - 1]
-            features.update({
-                '-1:word.lower()': word_prev.lower(),
-                '-1:word_prev()': word_prev,
-                '-1:word.istitle()': word_prev.istitle(),
-                '-1:word.isupper()': word_prev.isupper(),
-                '-1:word.islower()': word_prev.islower(),
-                '-1:word.isdigit()': word.isdigit(),
-            })
+            features.update(self.word_features(sent[i - 1]).context['-1'])
+            features['-1:word.isdigit()'] = isdigit
         else:
             features['BOS'] = True  # Beginning of sentence
 
         # Features from two words before
         if i > 1:
-            word_prev2 = sent[i - 2]
-            features.update({
-                '-2:word.lower()': word_prev2.lower(),
-                '-2:word_prev2()': word_prev2,
-                '-2:word.istitle()': word_prev2.istitle(),
-                '-2:word.isupper()': word_prev2.isupper(),
-                '-2:word.islower()': word_prev2.islower(),
-                '-2:word.isdigit()': word.isdigit(),
-            })
-        #else:
-        #    features['BOS2'] = True  # Two words from the beginning of sentence
+            features.update(self.word_features(sent[i - 2]).context['-2'])
+            features['-2:word.isdigit()'] = isdigit
 
         # Features from the next word
         if i < len(sent) - 1:
-            word_fwd = sent[i + 1]
-            features.update({
-                '+1:word.lower()': word_fwd.lower(),
-                '+1:word_fwd()': word_fwd,
-                '+1:word.istitle()': word_fwd.istitle(),
-                '+1:word.isupper()': word_fwd.isupper(),
-                '+1:word.islower()': word_fwd.islower(),
-                '+1:word.isdigit()': word.isdigit(),
-            })
+            features.update(self.word_features(sent[i + 1]).context['+1'])
+            features['+1:word.isdigit()'] = isdigit
         else:
             features['EOS'] = True  # End of sentence
 
         return features
 
+    @profiled('sent2features', lambda extractor, sent: extractor.sentence_counts(sent))
     def sent2features(self, sent):
         #this function creates a features of the sentence.
         feat = []
         for i in range(len(sent)):
             feat.append(self.word2features(sent, i))
-        return feat
\ No newline at end of file
+        return feat
+
+    @profiled('sent2items', lambda extractor, sent: extractor.sentence_counts(sent))
+    def sent2items(self, sent):
+        #the same features as sent2features, put straight into a pycrfsuite.ItemSequence
+        #from the cached attributes, which Tagger.tag() takes without converting them again
+        words = [self.word_features(word) for word in sent]
+        items = []
+
+        for i, word in enumerate(words):
+            item = dict(word.attributes)
+            isdigit = word.features['word.isdigit()']
+
+            if i > 0:
+                item.update(words[i - 1].context_attributes['-1'])
+                if isdigit:
+                    item['-1:word.isdigit()'] = 1.0
+            else:
+                item['BOS'] = 1.0
+            if i > 1:
+                item.update(words[i - 2].context_attributes['-2'])
+                if isdigit:
+                    item['-2:word.isdigit()'] = 1.0
+            if i < len(words) - 1:
+                item.update(words[i + 1].context_attributes['+1'])
+                if isdigit:
+                    item['+1:word.isdigit()'] = 1.0
+            else:
+                item['EOS'] = 1.0
+
+            items.append(item)
+
+        return pycrfsuite.ItemSequence(items)
+
+    def sentence_counts(self, sent):
+        #(tokens, unknown words, lattice size) for the profiling hooks, the lattice is left to the tagger
+        return len(sent), sum(word.lower() not in self.train_vocab for word in sent), None
+
+
+def feature_config_hash():
+    return hashlib.sha1(repr((FEATURE_VERSION, CONTEXT_NAMES)).encode('utf-8')).hexdigest()[:16]
+
+
+def to_attributes(features):
+    #the conversion pycrfsuite does: a string value becomes part of the name with weight 1,
+    #numbers and booleans are the weight. Attributes with weight 0 add nothing to the scores
+    #of crfsuite, so they are left out
+    attributes = {}
+    for name, value in features.items():
+        if isinstance(value, str):
+            attributes[name + ':' + value] = 1.0
+        elif value:
+            attributes[name] = float(value)
+    return attributes
+
+
+class CRFTaggerService:
+    # Tags lists of sentences in a pool of workers. Every worker opens its own
+    # pycrfsuite.Tagger, they can not be shared between threads.
+    # pycrfsuite keeps the GIL while it tags, so threads only overlap with the rest of the
+    # program (reading input, writing results). processes=True uses worker processes
+    # instead, which tag on several cores at once.
+    # chunk_size sentences are sent to a worker at a time.
+    # cache_size is the feature cache of every worker, result_cache_size > 0 keeps the tags
+    # of that many recent sentences in this process (see TagCache)
+    def __init__(self, model_file, train_vocab, n_workers=4, processes=False, chunk_size=64, cache_size=100000, result_cache_size=0):
+        self.chunk_size = chunk_size
+        self.n_workers = n_workers
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self.pool = executor(n_workers, initializer=open_worker, initargs=(model_file, train_vocab, cache_size))
+        self.cache = TagCache(result_cache_size) if result_cache_size > 0 else None
+        #a new service is a new model for the result cache, even with the same file
+        self.version = next(model_versions)
+
+    def tag(self, sentence):
+        return self.submit([sentence])()[0]
+
+    def submit(self, chunk):
+        #sends the chunk to a worker and returns a function which waits for its tags.
+        #sentences found in the result cache are not sent
+        if self.cache is None:
+            return self.pool.submit(tag_chunk, chunk).result
+
+        model = ('crf', self.version)
+        results = [self.cache.get(model, sentence) for sentence in chunk]
+        misses = [i for i, tags in enumerate(results) if tags is None]
+        future = self.pool.submit(tag_chunk, [chunk[i] for i in misses]) if misses else None
+
+        def result():
+            if future is not None:
+                for i, tags in zip(misses, future.result()):
+                    self.cache.put(model, chunk[i], tags)
+                    results[i] = tags
+            return results
+
+        return result
+
+    def tag_batch(self, sentences):
+        return list(self.tag_stream(sentences))
+
+    def tag_stream(self, sentences):
+        #yields the tags of every sentence in the input order, as soon as they are ready.
+        #sentences can be any iterable, at most two chunks per worker are in flight at a time
+        pending = deque()
+        chunk = []
+
+        for sentence in sentences:
+            chunk.append(sentence)
+            if len(chunk) == self.chunk_size:
+                pending.append(self.submit(chunk))
+                chunk = []
+            if len(pending) >= 2 * self.n_workers:
+                yield from pending.popleft()()
+
+        if chunk:
+            pending.append(self.submit(chunk))
+        while pending:
+            yield from pending.popleft()()
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_worker(model_file, train_vocab, cache_size):
+    worker.tagger = pycrfsuite.Tagger()
+    worker.tagger.open(model_file)
+    worker.feature_extractor = FeatureExtractor(train_vocab, cache_size)
+
+
+def tag_chunk(sentences):
+    return [tag_items(worker.tagger, worker.feature_extractor.sent2items(sentence)) for sentence in sentences]
+
+
+@profiled('crf_tag', lambda tagger, items: (len(items), None, len(items) * len(tagger.labels()) ** 2))
+def tag_items(tagger, items):
+    #the crfsuite lattice scores every pair of labels for every token
+    return tagger.tag(items)
+
+
+if __name__ == '__main__':
+    #rebuilds the vocabulary file from the corpus the model was trained on
+    import nltk
+    from nltk.corpus import brown
+
+    nltk.download('brown')
+    nltk.download('universal_tagset')
+    save_vocabulary({word.lower() for word in brown.words()})
@@ -1,17 +1,8 @@
 import streamlit as st
-from CRF import FeatureExtractor
-import nltk
-import pycrfsuite
-from nltk.corpus import brown
+from tagging_server import tag_remote
 import numpy as np
 
-nltk.download('brown')
-nltk.download('universal_tagset')
-dataset = list(brown.tagged_sents(tagset='universal'))
-train_vocab = {word.lower() for sent in dataset for word, _ in sent}
-feature_extractor = FeatureExtractor(train_vocab)
-tagger = pycrfsuite.Tagger()
-tagger.open('crf_pos_tagger_cv.model')
+#the model is loaded once by the tagging server (python tagging_server.py), not on every rerun
 
 st.set_page_config(
     page_title="POS Tagging with CRF Model",
@@ -37,8 +28,7 @@ with input:
 
     if st.button("Predict POS Tags"):
         words = sentence.split()
-        X = feature_extractor.sent2features(words)
-        y_pred = [tagger.tag(feature_extractor.sent2features(sent)) for sent in [words]]
+        y_pred = tag_remote([words], 'crf')[0]
         st.subheader("Result :")
         for i in range(len(words)):
-            st.markdown(f"{words[i]}  ->  {y_pred[0][i]}")
\ No newline at end of file
+            st.markdown(f"{words[i]}  ->  {y_pred[i]}")
\ No newline at end of file
@@ -1,10 +1,9 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-from HMM import HiddenMarkovModel, Viterbi, create_float_defaultdict
+from tagging_server import tag_remote
 
-model = HiddenMarkovModel()
-model.load()
+#the model is loaded once by the tagging server (python tagging_server.py), not on every rerun
 
 st.set_page_config(
     page_title="POS Tagging with Hidden Markov Model",
@@ -30,7 +29,7 @@ with input:
 
     if st.button("Predict POS Tags"):
         words = sentence.split()
-        tags = model.predict(words)
+        tags = tag_remote([words], 'hmm')[0]
         st.subheader("Result :")
         for i in range(len(words)):
             st.markdown(f"{words[i]}  ->  {tags[i]}")
\ No newline at end of file
@@ -0,0 +1,97 @@
+import argparse
+import random
+import time
+# Viterbi and create_float_defaultdict are needed to unpickle model.pkl
+from HMM import HiddenMarkovModel, Viterbi, create_float_defaultdict
+
+
+# The input is sampled from the model itself, so the benchmark runs offline
+# and the true tags of every word are known.
+def sample_tagged_words(viterbi, n_words, seed=26):
+    rng = random.Random(seed)
+    tags = sorted(viterbi.tags)
+
+    def draw(probs):
+        keys = list(probs.keys())
+        return rng.choices(keys, [probs[key] for key in keys])[0]
+
+    words, gold = [], []
+    tag = draw({tag: viterbi.initial_probs.get(tag, 0.0) for tag in tags})
+    for _ in range(n_words):
+        words.append(draw(viterbi.emission_probs[tag]))
+        gold.append(tag)
+        tag = draw(viterbi.transition_probs[tag])
+
+    return words, gold
+
+
+def accuracy(predicted, gold):
+    return sum(p == g for p, g in zip(predicted, gold)) / len(gold)
+
+
+def underflow_point(viterbi, words, tags):
+    #the number of words after which the old product of probabilities becomes 0.0
+    prob = viterbi.initial_probs.get(tags[0], 1e-7)
+    for t, (word, tag) in enumerate(zip(words, tags)):
+        if t > 0:
+            prob *= viterbi.transition_probs.get(tags[t - 1], {}).get(tag, 1e-7)
+        prob *= viterbi.emission_probs.get(tag, {}).get(word, 1e-7)
+        if prob == 0.0:
+            return t + 1
+    return None
+
+
+def best_time(decode, words, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        decode(words)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode very long inputs with the HMM tagger')
+    parser.add_argument('--model', default='model.pkl')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[1000, 2500, 5000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    model = HiddenMarkovModel()
+    model.load_pickle(args.model)
+    viterbi = model.viterbi
+    compiled = viterbi.compile()
+
+    n_words = max(args.lengths)
+    words, gold = sample_tagged_words(viterbi, n_words)
+
+    #correctness: one pass over the whole input against sentence sized pieces
+    long_tags = compiled.viterbi(words, renormalize=True)
+    piece_tags = [tag for start in range(0, n_words, 25) for tag in compiled.viterbi(words[start:start + 25])]
+    dict_tags = viterbi.viterbi(words, renormalize=True)
+
+    print(f'words: {n_words}')
+    print(f'product of probabilities underflows after {underflow_point(viterbi, words, gold)} words')
+    print(f'accuracy, one pass:        {accuracy(long_tags, gold):.4f}')
+    print(f'accuracy, 25 word pieces:  {accuracy(piece_tags, gold):.4f}')
+    print(f'compiled == dictionary decoder: {long_tags == dict_tags}')
+
+    assert long_tags == dict_tags, 'the two decoders disagree'
+    assert accuracy(long_tags, gold) >= accuracy(piece_tags, gold) - 0.01, 'one pass decoding lost accuracy'
+
+    #scaling: the time per word should stay flat as the input grows
+    print()
+    print(f'{"words":>8} {"seconds":>10} {"us/word":>10}')
+    per_word = []
+    for n in sorted(args.lengths):
+        seconds = best_time(lambda w: compiled.viterbi(w, renormalize=True), words[:n], args.repeat)
+        per_word.append(seconds / n)
+        print(f'{n:>8} {seconds:>10.4f} {seconds / n * 1e6:>10.2f}')
+
+    growth = per_word[-1] / per_word[0]
+    print(f'time per word, longest / shortest input: {growth:.2f}')
+    assert growth < 1.5, 'decode time grows faster than linearly'
+
+
+if __name__ == '__main__':
+    main()
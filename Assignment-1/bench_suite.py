@@ -0,0 +1,270 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pycrfsuite
+from CRF import FeatureExtractor, Vocabulary
+# Viterbi and create_float_defaultdict are needed to unpickle model.pkl
+from HMM import HiddenMarkovModel, Viterbi, create_float_defaultdict
+
+
+# Latency, throughput, load time and memory of every tagger backend on a fixed corpus
+# sample, written as JSON so that two versions can be compared:
+#   python bench_suite.py -o before.json
+#   python bench_suite.py --baseline before.json
+# The sample (bench_sample.conll, word<TAB>TAG lines, a blank line after every sentence)
+# is sampled from model.pkl by --make-sample, so the benchmark runs offline. It is synthetic
+# text, the taggers are not scored on it: their accuracy on text drawn from the HMM itself
+# says nothing about real text. meta.sample_synthetic records this, --real-sample for a
+# sample of real tagged text.
+# Every backend runs in a new process, so its load time and peak RSS do not depend on
+# the backends before it.
+SAMPLE_FILE = 'bench_sample.conll'
+
+# Sentence lengths the latencies are grouped by, the last group has no upper end
+LENGTH_BUCKETS = [(1, 10), (11, 20), (21, 40), (41, None)]
+
+
+def setup_hmm():
+    model = HiddenMarkovModel()
+    model.load('model.hmm')
+    return model.predict, model.predict_batch
+
+
+def setup_hmm_dictionary():
+    #the dictionary Viterbi.viterbi of model.pkl
+    model = HiddenMarkovModel()
+    model.load_pickle('model.pkl')
+    return model.predict, model.predict_batch
+
+
+def setup_crf():
+    tagger = pycrfsuite.Tagger()
+    tagger.open('crf_pos_tagger_cv.model')
+    #the vocabulary is read on first use, it is part of the load time here
+    vocabulary = Vocabulary()
+    vocabulary.load()
+    feature_extractor = FeatureExtractor(vocabulary)
+
+    def tag(sentence):
+        return tagger.tag(feature_extractor.sent2items(sentence))
+
+    return tag, lambda sentences: [tag(sentence) for sentence in sentences]
+
+
+def setup_crf_features():
+    #only FeatureExtractor.sent2features, the feature dicts of the CRF notebook
+    vocabulary = Vocabulary()
+    vocabulary.load()
+    feature_extractor = FeatureExtractor(vocabulary)
+    return feature_extractor.sent2features, lambda sentences: [feature_extractor.sent2features(sentence) for sentence in sentences]
+
+
+# name -> function returning (tag one sentence, tag a list of sentences)
+BACKENDS = {
+    'hmm': setup_hmm,
+    'hmm-dictionary': setup_hmm_dictionary,
+    'crf': setup_crf,
+    'crf-features': setup_crf_features,
+}
+
+
+def make_sample(filename, n_sentences=1000, seed=26, mean_length=20):
+    #sentences of random length are drawn from the initial, transition and emission
+    #probabilities of model.pkl, with their tags
+    model = HiddenMarkovModel()
+    model.load_pickle('model.pkl')
+    viterbi = model.viterbi
+    rng = random.Random(seed)
+
+    def draw(probs):
+        keys = sorted(probs)
+        return rng.choices(keys, [probs[key] for key in keys])[0]
+
+    emission_words = {tag: sorted(probs) for tag, probs in viterbi.emission_probs.items()}
+    emission_weights = {tag: [viterbi.emission_probs[tag][word] for word in words] for tag, words in emission_words.items()}
+
+    with open(filename, 'w', encoding='utf-8') as out:
+        for _ in range(n_sentences):
+            tag = draw(viterbi.initial_probs)
+            for _ in range(max(1, int(rng.expovariate(1 / mean_length)))):
+                word = rng.choices(emission_words[tag], emission_weights[tag])[0]
+                out.write(f'{word}\t{tag}\n')
+                tag = draw(viterbi.transition_probs[tag])
+            out.write('\n')
+
+
+def read_sample(filename):
+    sentences = []
+    sentence = []
+    with open(filename, encoding='utf-8') as inp:
+        for line in inp:
+            line = line.rstrip('\n')
+            if line:
+                word, tag = line.split('\t')
+                sentence.append((word, tag))
+            elif sentence:
+                sentences.append(sentence)
+                sentence = []
+    if sentence:
+        sentences.append(sentence)
+    return sentences
+
+
+def bucket_name(low, high):
+    return f'{low}+' if high is None else f'{low}-{high}'
+
+
+def length_bucket(length):
+    for low, high in LENGTH_BUCKETS:
+        if high is None or length <= high:
+            return bucket_name(low, high)
+
+
+def run_backend(name, sentences, repeat):
+    #runs in its own process, see main()
+    start = time.perf_counter()
+    tag, tag_batch = BACKENDS[name]()
+    load_seconds = time.perf_counter() - start
+
+    words = [[word for word, _ in sentence] for sentence in sentences]
+    n_tokens = sum(len(sentence) for sentence in words)
+    #one pass to fill the caches and page in the model, the numbers are for a warm tagger
+    tag_batch(words)
+
+    latencies = {bucket_name(low, high): [] for low, high in LENGTH_BUCKETS}
+    for sentence in words:
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            tag(sentence)
+            latencies[length_bucket(len(sentence))].append(time.perf_counter_ns() - start)
+
+    batch_seconds = best_time(tag_batch, words, repeat)
+
+    result = {
+        'load_seconds': load_seconds,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'latency_us': {bucket: {
+            'sentences': len(times) // repeat,
+            'p50': float(np.percentile(times, 50)) / 1000,
+            'p99': float(np.percentile(times, 99)) / 1000,
+        } for bucket, times in latencies.items() if times},
+        'throughput': {
+            'sentences_per_second': len(words) / batch_seconds,
+            'tokens_per_second': n_tokens / batch_seconds,
+        },
+    }
+    return result
+
+
+def best_time(function, argument, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    #prints how every number changed against the baseline and returns the regressions,
+    #changes for the worse which are larger than tolerance (0.2 is 20%) and than floor
+    regressions = []
+
+    def check(label, new, old, higher_is_better=False, floor=0.0):
+        if not old:
+            return
+        change = new / old - 1
+        worse = -change if higher_is_better else change
+        flag = '  REGRESSION' if worse > tolerance and abs(new - old) > floor else ''
+        print(f'{label:<45} {old:>12.2f} {new:>12.2f} {change:>+8.1%}{flag}')
+        if flag:
+            regressions.append(label)
+
+    print(f'{"":<45} {"baseline":>12} {"now":>12} {"change":>8}')
+    for name, result in results['backends'].items():
+        old = baseline['backends'].get(name)
+        if old is None:
+            continue
+        #load times of a few milliseconds are mostly noise
+        check(f'{name} load seconds', result['load_seconds'], old['load_seconds'], floor=0.05)
+        check(f'{name} peak RSS MB', result['peak_rss_mb'], old['peak_rss_mb'])
+        check(f'{name} tokens/s', result['throughput']['tokens_per_second'], old['throughput']['tokens_per_second'], higher_is_better=True)
+        for bucket, latency in result['latency_us'].items():
+            if bucket in old['latency_us']:
+                check(f'{name} {bucket} words p50 us', latency['p50'], old['latency_us'][bucket]['p50'])
+                check(f'{name} {bucket} words p99 us', latency['p99'], old['latency_us'][bucket]['p99'])
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency / throughput / memory benchmarks of the POS tagger backends')
+    parser.add_argument('--backends', nargs='+', choices=sorted(BACKENDS), default=list(BACKENDS))
+    parser.add_argument('--sample', default=SAMPLE_FILE)
+    parser.add_argument('--real-sample', action='store_true', help='the sample is real tagged text, not one written by --make-sample')
+    parser.add_argument('--sentences', type=int, default=None, help='only the first n sentences of the sample')
+    parser.add_argument('--repeat', type=int, default=3, help='timings per sentence and batch runs')
+    parser.add_argument('-o', '--output', default=None, help='JSON file for the results, stdout by default')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slow down against the baseline')
+    parser.add_argument('--make-sample', type=int, default=None, metavar='N', help='write a new sample of N sentences and exit')
+    args = parser.parse_args()
+
+    if args.make_sample is not None:
+        make_sample(args.sample, args.make_sample)
+        return
+
+    sentences = read_sample(args.sample)[:args.sentences]
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'sample': args.sample,
+            'sample_synthetic': not args.real_sample,
+            'sentences': len(sentences),
+            'tokens': sum(len(sentence) for sentence in sentences),
+            'repeat': args.repeat,
+        },
+        'backends': {},
+    }
+
+    #spawn, so a backend process does not start with the memory of this one
+    context = multiprocessing.get_context('spawn')
+    for name in args.backends:
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            results['backends'][name] = pool.submit(run_backend, name, sentences, args.repeat).result()
+        print(f'{name}: done', file=sys.stderr)
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as inp:
+            regressions = compare(results, json.load(inp), args.tolerance)
+        if regressions:
+            sys.exit(f'{len(regressions)} regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
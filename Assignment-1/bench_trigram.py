@@ -0,0 +1,65 @@
+import argparse
+import time
+import nltk
+from nltk.corpus import brown
+from HMM import HiddenMarkovModel
+
+
+# Accuracy and decode time of the trigram HMM for several beam widths, next to the
+# bigram HMM, on the Brown corpus with the universal tagset.
+def load_corpus():
+    nltk.download('brown', quiet=True)
+    nltk.download('universal_tagset', quiet=True)
+    #lowercased like in the notebooks
+    return [[(word.lower(), tag) for word, tag in sentence] for sentence in brown.tagged_sents(tagset='universal')]
+
+
+def evaluate(decode, sentences):
+    words = [[word for word, tag in sentence] for sentence in sentences]
+    start = time.perf_counter()
+    predicted = [decode(sentence) for sentence in words]
+    seconds = time.perf_counter() - start
+
+    correct = sum(p == tag for tags, sentence in zip(predicted, sentences) for p, (word, tag) in zip(tags, sentence))
+    total = sum(len(sentence) for sentence in sentences)
+    return correct / total, seconds / len(sentences), predicted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy / latency of the trigram HMM for several beam widths')
+    parser.add_argument('--beams', type=int, nargs='+', default=[0, 64, 16, 8, 4], help='0 is an exact search')
+    parser.add_argument('--max-candidates', type=int, default=6, help='candidate tags per word for the beam searches, 0 is all')
+    parser.add_argument('--test-fraction', type=float, default=0.1)
+    parser.add_argument('--test-sentences', type=int, default=2000)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    split = int(len(corpus) * (1 - args.test_fraction))
+    train, test = corpus[:split], corpus[split:][:args.test_sentences]
+    print(f'train sentences: {len(train)}, test sentences: {len(test)}')
+
+    bigram = HiddenMarkovModel()
+    bigram.train(train)
+    trigram = HiddenMarkovModel(order=3)
+    trigram.train(train)
+
+    print()
+    print(f'{"model":>8} {"beam":>6} {"candidates":>10} {"accuracy":>9} {"us/sentence":>12} {"same as exact":>14}')
+    accuracy, seconds, _ = evaluate(bigram.predict, test)
+    print(f'{"bigram":>8} {"-":>6} {"all":>10} {accuracy:>9.4f} {seconds * 1e6:>12.1f} {"-":>14}')
+
+    exact = None
+    for beam in args.beams:
+        viterbi = trigram.viterbi
+        viterbi.beam_width = beam or None
+        viterbi.max_candidates = (args.max_candidates or None) if beam else None
+        accuracy, seconds, predicted = evaluate(trigram.predict, test)
+        if exact is None and not beam:
+            exact = predicted
+        same = f'{sum(p == e for p, e in zip(predicted, exact)) / len(test):.4f}' if exact is not None else '-'
+        candidates = viterbi.max_candidates or 'all'
+        print(f'{"trigram":>8} {beam or "exact":>6} {candidates:>10} {accuracy:>9.4f} {seconds * 1e6:>12.1f} {same:>14}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import pycrfsuite
+import profiling
+from CRF import FeatureExtractor, Vocabulary, tag_items
+# Viterbi and create_float_defaultdict are needed to unpickle model.pkl
+from HMM import HiddenMarkovModel, Viterbi, create_float_defaultdict
+from bench_suite import read_sample
+
+
+# Calls every @profiled entry point with keyword arguments while profiling is on, and checks
+# that the result is the one of the same call with profiling off and that the call was recorded.
+def calls(sample):
+    sentences = [[word for word, _ in sentence] for sentence in sample[:50]]
+
+    compiled = HiddenMarkovModel()
+    compiled.load('model.hmm')
+    dictionary = HiddenMarkovModel()
+    dictionary.load_pickle('model.pkl')
+    trigram = HiddenMarkovModel(order=3)
+    trigram.train(sample)
+    extractor = FeatureExtractor(Vocabulary())
+    tagger = pycrfsuite.Tagger()
+    tagger.open('crf_pos_tagger_cv.model')
+
+    return [
+        ('hmm_predict', lambda: [compiled.predict(sentence=sentence, renormalize=True) for sentence in sentences]),
+        ('hmm_predict_batch', lambda: compiled.predict_batch(sentences=sentences, batch_size=16, renormalize=True)),
+        ('viterbi', lambda: [dictionary.viterbi.viterbi(sentence=sentence, renormalize=True) for sentence in sentences]),
+        ('compiled_viterbi', lambda: [compiled.viterbi.viterbi(sentence=sentence, renormalize=True) for sentence in sentences]),
+        ('compiled_viterbi_bucket', lambda: compiled.viterbi.viterbi_bucket(sentences=sentences[:8], renormalize=True)),
+        ('trigram_viterbi', lambda: [trigram.viterbi.viterbi(sentence=sentence, renormalize=True) for sentence in sentences]),
+        ('sent2features', lambda: [extractor.sent2features(sent=sentence) for sentence in sentences]),
+        ('sent2items', lambda: [len(extractor.sent2items(sent=sentence)) for sentence in sentences]),
+        ('crf_tag', lambda: [tag_items(tagger=tagger, items=extractor.sent2items(sentence)) for sentence in sentences]),
+    ]
+
+
+def main():
+    failures = 0
+    for stage, call in calls(read_sample('bench_sample.conll')):
+        profiling.disable()
+        expected = call()
+
+        profiling.enable()
+        profiling.registry.reset()
+        try:
+            result = call()
+        except Exception as error:
+            print(f'{stage:<24} FAIL  {type(error).__name__}: {error}')
+            failures += 1
+            continue
+        finally:
+            profiling.disable()
+
+        recorded = f'tagger_stage_seconds_count{{stage="{stage}"}}' in profiling.registry.to_prometheus()
+        ok = result == expected and recorded
+        failures += not ok
+        print(f'{stage:<24} {"ok" if ok else "FAIL"}')
+
+    if failures:
+        raise SystemExit(f'{failures} profiled entry points failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+import argparse
+import multiprocessing
+import os
+from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import pycrfsuite
+from sklearn.model_selection import KFold
+from CRF import FeatureExtractor
+from HMM import HiddenMarkovModel
+from feature_store import FeatureStore, build_feature_store
+
+
+# The tagged sentences of the cross validation, set once per worker process.
+# With the fork start method the workers get the parent's copy without pickling it.
+corpus = None
+
+CRF_PARAMS = {
+    'c1': 1.0,
+    'c2': 1e-3,
+    'max_iterations': 50,
+    'feature.possible_transitions': True
+}
+
+
+class Evaluation:
+
+    def __init__(self):
+
+        self.accuracy = []
+        #confusion_matrix[true tag][predicted tag] is a count, merged over all the folds
+        self.confusion_matrix = defaultdict(Counter)
+
+    def cross_validate(self, data, n=5, tagger='hmm', n_jobs=None, model_dir='cv_models', feature_store=None):
+
+        #the folds are the same as in the notebooks. Every fold runs in its own process
+        #and writes its model to model_dir, so no two folds share a file.
+        #feature_store is the file of a FeatureStore made from data, the CRF folds then
+        #read their features from it instead of extracting them. The folds are scored against
+        #data, so a store made from other sentences is refused
+        if tagger not in FOLD_FUNCTIONS:
+            raise ValueError(f'tagger has to be one of {sorted(FOLD_FUNCTIONS)}, not {tagger}')
+        if feature_store is not None and tagger == 'crf':
+            FeatureStore(feature_store).check_corpus(data)
+
+        global corpus
+        os.makedirs(model_dir, exist_ok=True)
+        k_fold = KFold(n_splits=n, shuffle=True, random_state=26)
+        folds = list(k_fold.split(data))
+        model_files = [os.path.join(model_dir, f'{tagger}_fold{k}{MODEL_EXTENSIONS[tagger]}') for k in range(n)]
+
+        if 'fork' in multiprocessing.get_all_start_methods():
+            corpus = data
+            pool = ProcessPoolExecutor(n_jobs or n, mp_context=multiprocessing.get_context('fork'))
+        else:
+            pool = ProcessPoolExecutor(n_jobs or n, initializer=share_corpus, initargs=(data,))
+
+        with pool:
+            run_fold = FOLD_FUNCTIONS[tagger]
+            if feature_store is not None and tagger == 'crf':
+                run_fold = partial(run_stored_crf_fold, feature_store=feature_store)
+            results = list(pool.map(run_fold, [train_i for train_i, _ in folds], [test_i for _, test_i in folds], model_files))
+        corpus = None
+
+        for accuracy, confusion in results:
+            self.accuracy.append(accuracy)
+            for (true_tag, predicted_tag), count in confusion.items():
+                self.confusion_matrix[true_tag][predicted_tag] += count
+
+        return np.mean(self.accuracy)
+
+    def tag_accuracies(self):
+
+        return {tag: row[tag] / sum(row.values()) for tag, row in self.confusion_matrix.items()}
+
+    def plot_eval(self):
+
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
+        tags = sorted(self.confusion_matrix.keys())
+        matrix = np.array([[self.confusion_matrix[true_tag][predicted_tag] for predicted_tag in tags] for true_tag in tags])
+
+        plt.figure(figsize=(10, 8))
+        sns.heatmap(matrix, annot=True, fmt="d", xticklabels=tags, yticklabels=tags)
+        plt.xlabel("Predicted")
+        plt.ylabel("True")
+        plt.title("Confusion Matrix")
+        plt.savefig("confusion_matrix_plot.png")
+        plt.show()
+
+        tag_accuracies = self.tag_accuracies()
+        for tag, accuracy in tag_accuracies.items():
+            print(f"Accuracy for {tag}: {accuracy:.3f}")
+
+        return tag_accuracies
+
+    def compute_f1(self):
+
+        #macro averages over the tags, straight from the confusion matrix
+        metrics = self.compute_per_tag_metrics()
+        precision = np.mean([tag_metrics['precision'] for tag_metrics in metrics.values()])
+        recall = np.mean([tag_metrics['recall'] for tag_metrics in metrics.values()])
+        f1 = np.mean([tag_metrics['f1_score'] for tag_metrics in metrics.values()])
+
+        print(f"Precision: {precision:.3f}")
+        print(f"Recall: {recall:.3f}")
+        print(f"F1 Score: {f1:.3f}")
+
+        return precision, recall, f1
+
+    def compute_per_tag_metrics(self):
+
+        tags = sorted(self.confusion_matrix.keys())
+        metrics = {}
+
+        for tag in tags:
+            tp = self.confusion_matrix[tag][tag]
+            fn = sum(self.confusion_matrix[tag][predicted_tag] for predicted_tag in tags if predicted_tag != tag)
+            fp = sum(self.confusion_matrix[true_tag][tag] for true_tag in tags if true_tag != tag)
+
+            precision = tp / (tp + fp) if (tp + fp) > 0 else 0
+            recall = tp / (tp + fn) if (tp + fn) > 0 else 0
+            f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+
+            metrics[tag] = {
+                "precision": precision,
+                "recall": recall,
+                "f1_score": f1
+            }
+
+        return metrics
+
+
+def share_corpus(data):
+    global corpus
+    corpus = data
+
+
+def score_fold(test_data, predicted):
+    #accuracy of the fold and the (true tag, predicted tag) counts
+    confusion = Counter()
+    for sentence, predicted_tags in zip(test_data, predicted):
+        confusion.update((tag, predicted_tag) for (_, tag), predicted_tag in zip(sentence, predicted_tags))
+
+    correct = sum(count for (true_tag, predicted_tag), count in confusion.items() if true_tag == predicted_tag)
+    return correct / sum(confusion.values()), confusion
+
+
+def run_hmm_fold(train_i, test_i, model_file):
+    train_data = [corpus[i] for i in train_i]
+    test_data = [corpus[i] for i in test_i]
+
+    pos_tagger = HiddenMarkovModel()
+    pos_tagger.train(train_data)
+    pos_tagger.save(model_file)
+
+    predicted = pos_tagger.predict_batch([[word for word, _ in sentence] for sentence in test_data])
+    return score_fold(test_data, predicted)
+
+
+def run_crf_fold(train_i, test_i, model_file):
+    train_data = [corpus[i] for i in train_i]
+    test_data = [corpus[i] for i in test_i]
+    train_vocab = {word.lower() for sent in train_data for word, _ in sent}
+    feature_extractor = FeatureExtractor(train_vocab)
+
+    trainer = pycrfsuite.Trainer(verbose=False)
+    for sentence in train_data:
+        trainer.append(feature_extractor.sent2items([word for word, _ in sentence]), [tag for _, tag in sentence])
+    trainer.set_params(CRF_PARAMS)
+    trainer.train(model_file)
+
+    tagger = pycrfsuite.Tagger()
+    tagger.open(model_file)
+    predicted = [tagger.tag(feature_extractor.sent2items([word for word, _ in sentence])) for sentence in test_data]
+    tagger.close()
+    return score_fold(test_data, predicted)
+
+
+def run_stored_crf_fold(train_i, test_i, model_file, feature_store):
+    store = FeatureStore(feature_store)
+    unknown_words = store.unknown_words(train_i)
+
+    trainer = pycrfsuite.Trainer(verbose=False)
+    for xseq, yseq in store.items(train_i, unknown_words):
+        trainer.append(xseq, yseq)
+    trainer.set_params(CRF_PARAMS)
+    trainer.train(model_file)
+
+    tagger = pycrfsuite.Tagger()
+    tagger.open(model_file)
+    predicted = [tagger.tag(xseq) for xseq, _ in store.items(test_i, unknown_words)]
+    tagger.close()
+    return score_fold([corpus[i] for i in test_i], predicted)
+
+
+def store_matches(filename, data):
+    if not os.path.exists(filename):
+        return False
+    try:
+        FeatureStore(filename).check_corpus(data)
+    except ValueError as error:
+        print(f'{filename} is made again: {error}')
+        return False
+    return True
+
+
+FOLD_FUNCTIONS = {'hmm': run_hmm_fold, 'crf': run_crf_fold}
+MODEL_EXTENSIONS = {'hmm': '.hmm', 'crf': '.model'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='k-fold cross validation of the HMM and CRF taggers on the Brown corpus')
+    parser.add_argument('tagger', choices=sorted(FOLD_FUNCTIONS))
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes, one per fold by default')
+    parser.add_argument('--model-dir', default='cv_models')
+    parser.add_argument('--feature-store', default=None, help='CRF feature store file, made from the corpus if it does not exist or was made from other data')
+    args = parser.parse_args()
+
+    import nltk
+    from nltk.corpus import brown
+
+    nltk.download('brown', quiet=True)
+    nltk.download('universal_tagset', quiet=True)
+    dataset = list(brown.tagged_sents(tagset='universal'))
+    #the HMM notebook lowercases the corpus, the CRF one keeps the case for its features
+    if args.tagger == 'hmm':
+        dataset = [[(word.lower(), tag) for word, tag in sentence] for sentence in dataset]
+
+    if args.feature_store is not None and args.tagger == 'crf' and not store_matches(args.feature_store, dataset):
+        build_feature_store(dataset, args.feature_store)
+
+    evaluation = Evaluation()
+    print(f'Accuracy: {evaluation.cross_validate(dataset, args.folds, args.tagger, args.jobs, args.model_dir, args.feature_store):.4f}')
+    evaluation.compute_f1()
+    for tag, tag_metrics in evaluation.compute_per_tag_metrics().items():
+        print(f"{tag}  P: {tag_metrics['precision']:.3f}, R: {tag_metrics['recall']:.3f}, F1: {tag_metrics['f1_score']:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import hashlib
+import numpy as np
+import pycrfsuite
+from CRF import FeatureExtractor, feature_config_hash
+from HMM import encode_strings, decode_strings, write_arrays, read_arrays
+
+
+# A feature store holds the CRF features of a whole tagged corpus, made once, so that
+# training runs and cross validation folds do not run the feature extractor again.
+# It uses the array layout of the .hmm files (see HMM.py) with these sections:
+#   config        the feature_config_hash() the features were made with
+#   corpus        the corpus_fingerprint() of the tagged sentences the store was made from
+#   attributes    every distinct crfsuite attribute name
+#   words         every distinct lowercased word
+#   labels        every distinct tag
+#   sentences     start of every sentence in the tokens, plus the end (sentence id -> tokens)
+#   tokens        start of every token in attr_ids, plus the end
+#   token_words   the lowercased word of every token
+#   token_labels  the tag of every token
+#   attr_ids      the attributes of all the tokens, one after another
+#   attr_weights  their weights
+# is_unknown depends on the training vocabulary, so it is not stored. It is added
+# for every fold from the words of the fold's training sentences.
+STORE_MAGIC = b'CRFFEATS'
+
+
+def sentence_bytes(sentence):
+    return ''.join(f'{word}\t{tag}\n' for word, tag in sentence).encode('utf-8') + b'\n'
+
+
+def corpus_fingerprint(tagged_sentences):
+    #hash of the words and tags of all the sentences in order, a store is only used with the
+    #corpus it was made from because its sentence ids are positions in that corpus
+    fingerprint = hashlib.sha1()
+    for sentence in tagged_sentences:
+        fingerprint.update(sentence_bytes(sentence))
+    return fingerprint.hexdigest()[:16]
+
+
+def build_feature_store(tagged_sentences, filename):
+    #sentence ids are the positions of the sentences in tagged_sentences
+    feature_extractor = FeatureExtractor(())
+    attribute_index = {}
+    word_index = {}
+    label_index = {}
+    sentences = [0]
+    tokens = [0]
+    token_words = []
+    token_labels = []
+    attr_ids = []
+    attr_weights = []
+    fingerprint = hashlib.sha1()
+
+    for sentence in tagged_sentences:
+        fingerprint.update(sentence_bytes(sentence))
+        words = [word for word, _ in sentence]
+        for (word, tag), item in zip(sentence, feature_extractor.sent2items(words).items()):
+            del item['is_unknown']
+            for name, weight in item.items():
+                attr_ids.append(attribute_index.setdefault(name, len(attribute_index)))
+                attr_weights.append(weight)
+            tokens.append(len(attr_ids))
+            token_words.append(word_index.setdefault(word.lower(), len(word_index)))
+            token_labels.append(label_index.setdefault(tag, len(label_index)))
+        sentences.append(len(token_words))
+
+    write_arrays(filename, {
+        'config': encode_strings([feature_config_hash()]),
+        'corpus': encode_strings([fingerprint.hexdigest()[:16]]),
+        'attributes': encode_strings(list(attribute_index)),
+        'words': encode_strings(list(word_index)),
+        'labels': encode_strings(list(label_index)),
+        'sentences': np.array(sentences, dtype=np.int64),
+        'tokens': np.array(tokens, dtype=np.int64),
+        'token_words': np.array(token_words, dtype=np.int32),
+        'token_labels': np.array(token_labels, dtype=np.int32),
+        'attr_ids': np.array(attr_ids, dtype=np.int32),
+        'attr_weights': np.array(attr_weights, dtype=np.float32),
+    }, STORE_MAGIC)
+
+
+class FeatureStore:
+
+    def __init__(self, filename):
+
+        #the arrays are read only memory maps, worker processes which open the same
+        #store share it in the page cache
+        self.arrays = read_arrays(filename, STORE_MAGIC)
+        config = decode_strings(self.arrays['config'])[0]
+        if config != feature_config_hash():
+            raise ValueError(f'{filename} was made with other features ({config}), build it again')
+        if 'corpus' not in self.arrays:
+            raise ValueError(f'{filename} does not record the corpus it was made from, build it again')
+        self.filename = filename
+        self.corpus = decode_strings(self.arrays['corpus'])[0]
+
+        #an object array, so that the names of many ids are looked up with one take()
+        self.attributes = np.array(decode_strings(self.arrays['attributes']), dtype=object)
+        self.words = decode_strings(self.arrays['words'])
+        self.labels = decode_strings(self.arrays['labels'])
+        #plain ndarray views of the memory map, slicing them is faster than slicing a np.memmap
+        self.sentences = np.asarray(self.arrays['sentences'])
+        self.tokens = np.asarray(self.arrays['tokens'])
+        self.token_words = np.asarray(self.arrays['token_words'])
+        self.token_labels = np.asarray(self.arrays['token_labels'])
+        self.attr_ids = np.asarray(self.arrays['attr_ids'])
+        self.attr_weights = np.asarray(self.arrays['attr_weights'])
+
+    def __len__(self):
+
+        return len(self.sentences) - 1
+
+    def check_corpus(self, tagged_sentences):
+
+        #raises ValueError unless the store was made from exactly these sentences, in this order
+        if len(self) != len(tagged_sentences):
+            raise ValueError(f'{self.filename} has {len(self)} sentences, the corpus has {len(tagged_sentences)}, build it again')
+        if self.corpus != corpus_fingerprint(tagged_sentences):
+            raise ValueError(f'{self.filename} was made from another corpus or another order of it, build it again')
+
+    def unknown_words(self, train_ids):
+
+        #a mask over the stored words, True for the words which are not in the training
+        #sentences. The tokens of the training sentences are marked with a running sum
+        #over +1 at the start and -1 at the end of every sentence
+        train_ids = np.asarray(train_ids)
+        in_train = np.zeros(len(self.token_words) + 1, dtype=np.int64)
+        np.add.at(in_train, self.sentences[train_ids], 1)
+        np.add.at(in_train, self.sentences[train_ids + 1], -1)
+
+        unknown = np.ones(len(self.words), dtype=bool)
+        unknown[self.token_words[np.cumsum(in_train[:-1]) > 0]] = False
+        return unknown
+
+    def sentence_labels(self, sentence_id):
+
+        start, end = self.sentences[sentence_id], self.sentences[sentence_id + 1]
+        return [self.labels[i] for i in self.token_labels[start:end].tolist()]
+
+    def sentence_items(self, sentence_id, unknown_words):
+
+        #the stored attributes of every token with is_unknown put back from the mask
+        start, end = self.sentences[sentence_id], self.sentences[sentence_id + 1]
+        offsets = (self.tokens[start:end + 1] - self.tokens[start]).tolist()
+        first, last = self.tokens[start], self.tokens[end]
+        names = self.attributes.take(self.attr_ids[first:last]).tolist()
+        weights = self.attr_weights[first:last].tolist()
+        unknown = unknown_words[self.token_words[start:end]].tolist()
+
+        items = []
+        for t in range(end - start):
+            item = dict(zip(names[offsets[t]:offsets[t + 1]], weights[offsets[t]:offsets[t + 1]]))
+            if unknown[t]:
+                item['is_unknown'] = 1.0
+            items.append(item)
+
+        return pycrfsuite.ItemSequence(items)
+
+    def items(self, sentence_ids, unknown_words):
+
+        #streams (ItemSequence, labels) pairs, only one sentence is built at a time
+        for sentence_id in sentence_ids:
+            yield self.sentence_items(sentence_id, unknown_words), self.sentence_labels(sentence_id)
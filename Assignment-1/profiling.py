@@ -0,0 +1,162 @@
+from bisect import bisect_left
+from functools import wraps
+import inspect
+import os
+import threading
+import time
+
+
+# Opt-in timings and counters of the tagging hot paths, exported in the Prometheus text format.
+# The functions decorated with @profiled only check this flag while it is off, so leaving
+# the hooks in costs one function call. Turn it on with enable() or TAGGER_PROFILE=1.
+enabled = os.environ.get('TAGGER_PROFILE', '') not in ('', '0')
+
+# Upper bounds of the histogram buckets, every histogram also has +Inf
+SECONDS_BUCKETS = [1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0]
+TOKENS_BUCKETS = [1, 5, 10, 20, 40, 80, 160, 1000, 10000, 100000]
+RATIO_BUCKETS = [0.0, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0]
+LATTICE_BUCKETS = [100, 1000, 10000, 100000, 1000000, 10000000]
+
+# name -> (type, help, buckets), every metric has a stage label
+METRICS = {
+    'tagger_stage_seconds': ('histogram', 'Seconds per call of a tagging stage', SECONDS_BUCKETS),
+    'tagger_stage_tokens': ('histogram', 'Tokens per call of a tagging stage', TOKENS_BUCKETS),
+    'tagger_oov_ratio': ('histogram', 'Share of the tokens of a call which are not in the vocabulary', RATIO_BUCKETS),
+    'tagger_lattice_cells': ('histogram', 'Transitions scored by the lattice search of a call', LATTICE_BUCKETS),
+    'tagger_tokens_total': ('counter', 'Tokens seen by a tagging stage', None),
+    'tagger_oov_tokens_total': ('counter', 'Out of vocabulary tokens seen by a tagging stage', None),
+}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        #counts[i] is the number of values in (buckets[i - 1], buckets[i]], the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+
+    # One Histogram or counter value per (metric name, stage). Locked, the tagging
+    # server records from many threads.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, stage, value):
+        with self.lock:
+            histogram = self.histograms.get((name, stage))
+            if histogram is None:
+                histogram = self.histograms[(name, stage)] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    def count(self, name, stage, value=1):
+        with self.lock:
+            self.counters[(name, stage)] = self.counters.get((name, stage), 0) + value
+
+    def record(self, stage, seconds, tokens=None, oov=None, lattice=None):
+        self.observe('tagger_stage_seconds', stage, seconds)
+        if tokens is not None:
+            self.observe('tagger_stage_tokens', stage, tokens)
+            self.count('tagger_tokens_total', stage, tokens)
+        if oov is not None:
+            self.count('tagger_oov_tokens_total', stage, oov)
+            if tokens:
+                self.observe('tagger_oov_ratio', stage, oov / tokens)
+        if lattice is not None:
+            self.observe('tagger_lattice_cells', stage, lattice)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets) in METRICS.items():
+                stages = sorted(stage for metric, stage in (self.histograms if kind == 'histogram' else self.counters) if metric == name)
+                if not stages:
+                    continue
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+                for stage in stages:
+                    if kind == 'counter':
+                        lines.append(f'{name}{{stage="{stage}"}} {self.counters[(name, stage)]}')
+                        continue
+                    histogram = self.histograms[(name, stage)]
+                    cumulative = 0
+                    for bound, count in zip(buckets + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def profiled(stage, counts=None):
+    #decorator which records the time of every call of the function as the given stage.
+    #counts is called with the arguments of the call, all of them positional in the order of
+    #the function's parameters (keyword arguments are bound to their positions first), and
+    #returns the (tokens, oov, lattice) of the call, None for the ones it does not know
+    def decorate(function):
+        signature = inspect.signature(function)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            if counts is None:
+                registry.record(stage, seconds)
+            else:
+                registry.record(stage, seconds, *counts(*signature.bind(*args, **kwargs).args))
+            return result
+
+        return wrapper
+
+    return decorate
+
+
+class stage:
+
+    # the same for a block of code:  with stage('tokenize'): ...
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            registry.record(self.name, time.perf_counter() - self.start)
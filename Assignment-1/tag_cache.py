@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from itertools import count
+import threading
+
+
+# Every loaded or trained model gets a new version from here. It is part of the cache keys,
+# so the tags of an older model are never returned after a retrain or a hot swap.
+model_versions = count(1)
+
+
+class TagCache:
+
+    # Keeps the tags of the max_size most recently tagged sentences. A key is the model
+    # (any hashable, e.g. ('hmm', version)) and the tuple of tokens of the sentence.
+    # It is locked, the tagging server uses it from many threads.
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model, sentence):
+        key = (model, tuple(sentence))
+        with self.lock:
+            tags = self.entries.get(key)
+            if tags is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return list(tags)
+
+    def put(self, model, sentence, tags):
+        key = (model, tuple(sentence))
+        with self.lock:
+            self.entries[key] = tuple(tags)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def tag_batch(self, model, sentences, tag_sentences):
+        #the cached sentences are looked up, tag_sentences(list of sentences) tags the others
+        results = [self.get(model, sentence) for sentence in sentences]
+        misses = [i for i, tags in enumerate(results) if tags is None]
+
+        if misses:
+            for i, tags in zip(misses, tag_sentences([sentences[i] for i in misses])):
+                self.put(model, sentences[i], tags)
+                results[i] = tags
+
+        return results
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'max_size': self.max_size}
@@ -0,0 +1,146 @@
+import argparse
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import CRF
+from CRF import VOCABULARY_FILE, Vocabulary
+from HMM import HiddenMarkovModel
+
+
+# Tags a text or CoNLL file of any size with the HMM or CRF tagger:
+#   python tag_corpus.py corpus.txt --model crf --jobs 4 -o corpus.tagged
+# The input is read and tokenized lazily, batch_size sentences at a time are sent to the
+# worker processes and at most two batches per worker are in flight, so memory does not
+# grow with the input. The output is in the order of the input.
+# Input formats:
+#   text   one sentence per line, tokens split on whitespace (or with nltk.word_tokenize).
+#          A blank line is an empty sentence, it is kept as a blank line of the output
+#   conll  one token per line, the token in the given column, a blank line after every
+#          sentence, lines starting with # are comments
+# Output formats:
+#   text   one sentence per line as word/TAG
+#   conll  word<TAB>TAG lines, a blank line after every sentence
+
+# The HMM of the current worker process, see open_hmm_worker
+hmm_model = None
+
+
+def open_hmm_worker(model_file):
+    global hmm_model
+    hmm_model = HiddenMarkovModel()
+    hmm_model.load(model_file)
+
+
+def tag_hmm_chunk(sentences):
+    return hmm_model.predict_batch(sentences)
+
+
+def read_text(lines, tokenize=str.split):
+    for line in lines:
+        #blank lines are empty sentences, so every output line is the tags of its input line
+        yield list(tokenize(line))
+
+
+def read_conll(lines, column=0):
+    sentence = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip():
+            if sentence:
+                yield sentence
+            sentence = []
+        elif not line.startswith('#'):
+            fields = line.split('\t') if '\t' in line else line.split()
+            sentence.append(fields[column])
+    if sentence:
+        yield sentence
+
+
+def write_text(out, sentence, tags):
+    out.write(' '.join(f'{word}/{tag}' for word, tag in zip(sentence, tags)) + '\n')
+
+
+def write_conll(out, sentence, tags):
+    out.write(''.join(f'{word}\t{tag}\n' for word, tag in zip(sentence, tags)) + '\n')
+
+
+def batches(sentences, batch_size):
+    sentences = iter(sentences)
+    while batch := list(islice(sentences, batch_size)):
+        yield batch
+
+
+def tag_batches(pool, tag_function, batches, max_pending):
+    #yields (batch, tags) in the input order, a new batch is only read when one of the
+    #max_pending batches in flight is done
+    pending = deque()
+    for batch in batches:
+        pending.append((batch, pool.submit(tag_function, batch)))
+        if len(pending) >= max_pending:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+    while pending:
+        batch, future = pending.popleft()
+        yield batch, future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tag a text or CoNLL file with the HMM or CRF POS tagger')
+    parser.add_argument('input', help='input file, - for stdin')
+    parser.add_argument('-o', '--output', default='-', help='output file, - for stdout')
+    parser.add_argument('--model', choices=['hmm', 'crf'], default='hmm')
+    parser.add_argument('--format', choices=['text', 'conll'], default='text', help='input format')
+    parser.add_argument('--output-format', choices=['text', 'conll'], default=None, help='the input format by default')
+    parser.add_argument('--column', type=int, default=0, help='token column of CoNLL input')
+    parser.add_argument('--tokenizer', choices=['whitespace', 'nltk'], default='whitespace', help='tokenizer of text input')
+    parser.add_argument('--jobs', type=int, default=2, help='worker processes')
+    parser.add_argument('--batch-size', type=int, default=256, help='sentences sent to a worker at a time')
+    parser.add_argument('--hmm-model', default='model.hmm')
+    parser.add_argument('--crf-model', default='crf_pos_tagger_cv.model')
+    parser.add_argument('--crf-vocab', default=VOCABULARY_FILE)
+    parser.add_argument('--progress', type=float, default=0, help='seconds between progress lines on stderr, 0 for none')
+    args = parser.parse_args()
+
+    if args.model == 'hmm':
+        initializer, initargs, tag_function = open_hmm_worker, (args.hmm_model,), tag_hmm_chunk
+    else:
+        initializer, initargs, tag_function = CRF.open_worker, (args.crf_model, Vocabulary(args.crf_vocab), 100000), CRF.tag_chunk
+
+    tokenize = str.split
+    if args.tokenizer == 'nltk':
+        import nltk
+        nltk.download('punkt_tab', quiet=True)
+        tokenize = nltk.word_tokenize
+
+    inp = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    sentences = read_conll(inp, args.column) if args.format == 'conll' else read_text(inp, tokenize)
+    write = write_conll if (args.output_format or args.format) == 'conll' else write_text
+
+    n_sentences = n_tokens = 0
+    start = last_report = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(args.jobs, initializer=initializer, initargs=initargs) as pool:
+            for batch, tags in tag_batches(pool, tag_function, batches(sentences, args.batch_size), 2 * args.jobs):
+                for sentence, sentence_tags in zip(batch, tags):
+                    write(out, sentence, sentence_tags)
+                n_sentences += len(batch)
+                n_tokens += sum(len(sentence) for sentence in batch)
+
+                if args.progress and time.perf_counter() - last_report >= args.progress:
+                    last_report = time.perf_counter()
+                    print(f'{n_sentences} sentences, {n_tokens / (last_report - start):.0f} tokens/s', file=sys.stderr)
+    finally:
+        if inp is not sys.stdin:
+            inp.close()
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    print(f'tagged {n_sentences} sentences, {n_tokens} tokens in {elapsed:.2f}s ({n_tokens / max(elapsed, 1e-9):.0f} tokens/s)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import argparse
+import json
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import Request, urlopen
+from CRF import CRFTaggerService, VOCABULARY_FILE, Vocabulary
+from HMM import HiddenMarkovModel
+import profiling
+
+
+# One long lived process which loads the HMM and CRF taggers once and tags over HTTP:
+#   GET  /tag?model=hmm&text=The+jury+said+it      one sentence, split on whitespace
+#   POST /tag?model=crf  {"sentences": [...]}      a batch, every sentence is a list of
+#                                                  tokens or a string which is split
+#   GET  /health                                   the loaded models and result cache counters
+#   GET  /metrics                                  stage timings and counters in the Prometheus
+#                                                  text format, when started with --profile
+# Answers are JSON, {"model": ..., "tags": [[...], ...]} with one list of tags per sentence.
+# Every request is handled in its own thread, CRF sentences are tagged by the worker pool
+# of CRFTaggerService, so a slow batch does not hold up the other requests.
+SERVER_URL = 'http://127.0.0.1:8626'
+
+
+class Taggers:
+
+    def __init__(self, hmm_model='model.hmm', crf_model='crf_pos_tagger_cv.model', crf_vocab=VOCABULARY_FILE, crf_workers=4, cache_size=10000):
+
+        self.hmm = HiddenMarkovModel(cache_size=cache_size)
+        self.hmm.load(hmm_model)
+        self.crf = CRFTaggerService(crf_model, Vocabulary(crf_vocab), n_workers=crf_workers, result_cache_size=cache_size)
+
+    def cache_info(self):
+
+        return {name: tagger.cache.info() for name, tagger in [('hmm', self.hmm), ('crf', self.crf)] if tagger.cache is not None}
+
+    def tag(self, model, sentences):
+
+        if model == 'hmm':
+            return self.hmm.predict_batch(sentences)
+        if model == 'crf':
+            return self.crf.tag_batch(sentences)
+        raise ValueError(f'model has to be hmm or crf, not {model!r}')
+
+    def close(self):
+
+        self.crf.close()
+
+
+class TaggingHandler(BaseHTTPRequestHandler):
+
+    #set by serve()
+    taggers = None
+
+    def do_GET(self):
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/health':
+            return self.send_json(200, {'models': ['hmm', 'crf'], 'cache': self.taggers.cache_info()})
+        if url.path == '/metrics':
+            return self.send_text(200, profiling.registry.to_prometheus())
+        if url.path != '/tag':
+            return self.send_json(404, {'error': f'unknown path {url.path}'})
+
+        self.tag(query.get('model', ['hmm'])[0], [query.get('text', [''])[0]])
+
+    def do_POST(self):
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path != '/tag':
+            return self.send_json(404, {'error': f'unknown path {url.path}'})
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            sentences = body['sentences']
+            if not isinstance(sentences, list) or not all(is_sentence(sentence) for sentence in sentences):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            return self.send_json(400, {'error': 'the body has to be JSON like {"sentences": [...]}, every sentence a string or a list of string tokens'})
+
+        self.tag(query.get('model', ['hmm'])[0], sentences)
+
+    def tag(self, model, sentences):
+
+        with profiling.stage('tokenize'):
+            sentences = [sentence.split() if isinstance(sentence, str) else sentence for sentence in sentences]
+        try:
+            with profiling.stage('tag'):
+                tags = self.taggers.tag(model, sentences)
+        except ValueError as error:
+            return self.send_json(400, {'error': str(error)})
+        except Exception as error:
+            #the traceback goes to stderr, the client only gets the type of the error
+            traceback.print_exc()
+            return self.send_json(500, {'error': f'tagging failed with {type(error).__name__}'})
+
+        with profiling.stage('format'):
+            self.send_json(200, {'model': model, 'tags': tags})
+
+    def send_json(self, status, answer):
+
+        self.send_body(status, json.dumps(answer).encode('utf-8'), 'application/json')
+
+    def send_text(self, status, text):
+
+        self.send_body(status, text.encode('utf-8'), 'text/plain; version=0.0.4')
+
+    def send_body(self, status, body, content_type):
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+
+        #no line on stderr for every request
+        pass
+
+
+def is_sentence(sentence):
+    return isinstance(sentence, str) or (isinstance(sentence, list) and all(isinstance(token, str) for token in sentence))
+
+
+def serve(taggers, host='127.0.0.1', port=8626):
+    TaggingHandler.taggers = taggers
+    server = ThreadingHTTPServer((host, port), TaggingHandler)
+    server.daemon_threads = True
+    return server
+
+
+def tag_remote(sentences, model='hmm', url=SERVER_URL, timeout=30):
+    #client for the UIs: sends a batch of sentences and returns their tags
+    request = Request(f'{url}/tag?{urlencode({"model": model})}', data=json.dumps({'sentences': sentences}).encode('utf-8'),
+                      headers={'Content-Type': 'application/json'})
+    with urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())['tags']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP server for the HMM and CRF POS taggers')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8626)
+    parser.add_argument('--hmm-model', default='model.hmm')
+    parser.add_argument('--crf-model', default='crf_pos_tagger_cv.model')
+    parser.add_argument('--crf-vocab', default=VOCABULARY_FILE)
+    parser.add_argument('--crf-workers', type=int, default=4)
+    parser.add_argument('--cache-size', type=int, default=10000, help='sentences kept in the result cache of each tagger, 0 turns it off')
+    parser.add_argument('--profile', action='store_true', help='record stage timings for /metrics')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable()
+    taggers = Taggers(args.hmm_model, args.crf_model, args.crf_vocab, args.crf_workers, args.cache_size)
+    server = serve(taggers, args.host, args.port)
+    print(f'tagging on http://{args.host}:{args.port}/tag?model=hmm|crf')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        taggers.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import string
+import numpy as np
+import nltk
+from sklearn.feature_extraction import DictVectorizer
+from sklearn.metrics import classification_report, confusion_matrix, ConfusionMatrixDisplay
+from sklearn.model_selection import cross_val_predict, KFold
+from sklearn.svm import LinearSVC
+
+
+# The classes of NER.ipynb. Every token is classified as O (0) or part of a named entity, B/I (1).
+LABELS = ['O', 'B/I']
+
+punctuation = set(string.punctuation)
+
+
+# DataLoader Class to load and transform data
+class DataLoader:
+    @staticmethod
+    def load_conll2003():
+        from datasets import load_dataset
+
+        dataset = load_dataset("conll2003", trust_remote_code=True)
+        return dataset['train'], dataset['test'], dataset['validation']
+
+    @staticmethod
+    def transform_to_dataset(dataset):
+        X, y = [], []
+
+        for item in dataset:
+            tokens = item['tokens']
+            pos_tags = item['pos_tags']
+            ner_tags = item['ner_tags']
+
+            X.extend(FeatureExtractor.sentence_features(tokens, pos_tags))
+            y.extend(1 if tag != 0 else 0 for tag in ner_tags)  # In the dataset 0 is for O while other values form 1 to 8 are for B/I
+
+        return X, y
+
+
+# FeatureExtractor Class to extract features from tokens
+class FeatureExtractor:
+    # the english stop words of nltk, read the first time they are needed
+    stop_words = None
+
+    @classmethod
+    def load_stop_words(cls):
+        if cls.stop_words is None:
+            from nltk.corpus import stopwords
+
+            nltk.download('stopwords', quiet=True)
+            cls.stop_words = frozenset(stopwords.words('english'))
+        return cls.stop_words
+
+    @staticmethod
+    def extract_features(tokens, pos_tags, i):
+        word = tokens[i]
+        postag = pos_tags[i]
+        stop_words = FeatureExtractor.load_stop_words()
+
+        features = {
+            'word': word,       # basic word features
+            'word_lower': word.lower(),
+            'is_title': word.istitle(),
+            #'is_capitalized': word[0].upper() == word[0],
+            'is_all_caps': word.upper() == word,
+            'is_all_lower': word.lower() == word,
+            'prefix-1': word[0],
+            'prefix-2': word[:2],
+            'suffix-1': word[-1],
+            'suffix-2': word[-2:],
+            'is_stopword': word.lower() in stop_words,
+            'is_punctuation': word in punctuation,
+
+            'is_first': i == 0,     # sentence position features
+            'is_last': i == len(tokens) - 1,
+
+            'prev_word': '' if i == 0 else tokens[i - 1],   # contextual features
+            'prev_word_is_title': '' if i == 0 else tokens[i - 1].istitle(),
+            'next_word': '' if i == len(tokens) - 1 else tokens[i + 1],
+            'next_word_is_title': '' if i == len(tokens) - 1 else tokens[i + 1].istitle(),
+
+            #'postag': postag,      # POS tags for context
+            #'prev_postag': '' if i == 0 else pos_tags[i - 1],
+            #'next_postag': '' if i == len(pos_tags) - 1 else pos_tags[i + 1],
+        }
+
+        return features
+
+    @staticmethod
+    def sentence_features(tokens, pos_tags):
+        return [FeatureExtractor.extract_features(tokens, pos_tags, i) for i in range(len(tokens))]
+
+
+# ModelTrainer Class for training and cross-validation
+class ModelTrainer:
+    def __init__(self, X):
+        self.vectorizer = DictVectorizer(sparse=True)
+        self.model = LinearSVC(max_iter=10000)
+        self.vectorizer.fit(X)
+
+    def fit(self, X, y):
+        X = self.vectorizer.fit_transform(X)
+        self.model.fit(X, y)
+
+    def cross_validate(self, X, y, folds=5):
+        import matplotlib.pyplot as plt
+
+        X = self.vectorizer.fit_transform(X)
+        kf = KFold(n_splits=folds, shuffle=True, random_state=42)
+        y_pred = cross_val_predict(self.model, X, y, cv=kf)
+
+        print("Classification Report (5-Fold Cross-Validation):")
+        print(classification_report(y, y_pred))
+
+        # Plot confusion matrix
+        cm = confusion_matrix(y, y_pred)
+        disp = ConfusionMatrixDisplay(confusion_matrix=cm, display_labels=LABELS)
+        disp.plot(cmap="Greys")
+        plt.title("Confusion Matrix")
+        plt.show()
+
+
+# Predictor Class to predict NER for sentences
+class Predictor:
+    # batch_size sentences are POS tagged, vectorized and classified together, with one
+    # call each to the POS tagger, vectorizer.transform and model.predict
+    def __init__(self, model, vectorizer, batch_size=256):
+        self.model = model
+        self.vectorizer = vectorizer
+        self.batch_size = batch_size
+        self.pos_tagger = None
+
+    def tag_pos(self, sentences):
+        #nltk.pos_tag loads the perceptron tagger again on every call, it is kept here instead
+        if self.pos_tagger is None:
+            nltk.download('averaged_perceptron_tagger_eng', quiet=True)
+            self.pos_tagger = nltk.PerceptronTagger()
+        return [[tag for _, tag in self.pos_tagger.tag(tokens)] for tokens in sentences]
+
+    def predict_single_sentence(self, sentence):
+        return self.predict_sentences([sentence])[0]
+
+    def predict_sentences(self, sentences):
+        #sentences are strings, which are tokenized with nltk.word_tokenize, or lists of tokens.
+        #returns a list of (token, label) pairs for every sentence
+        token_lists = [nltk.word_tokenize(sentence) if isinstance(sentence, str) else list(sentence) for sentence in sentences]
+        results = []
+
+        for start in range(0, len(token_lists), self.batch_size):
+            batch = token_lists[start:start + self.batch_size]
+            features = [features for tokens, pos_tags in zip(batch, self.tag_pos(batch))
+                        for features in FeatureExtractor.sentence_features(tokens, pos_tags)]
+            predicted = self.model.predict(self.vectorizer.transform(features)) if features else np.zeros(0, dtype=int)
+
+            #the predictions of all the tokens of the batch, split back into sentences
+            ends = np.cumsum([len(tokens) for tokens in batch]).tolist()
+            for tokens, end in zip(batch, ends):
+                results.append(list(zip(tokens, [LABELS[tag] for tag in predicted[end - len(tokens):end].tolist()])))
+
+        return results
@@ -0,0 +1,50 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+from sklearn.model_selection import KFold
+from sklearn.svm import LinearSVC
+from ner_evaluation import predict
+
+
+# k-fold cross validation of the NER SVM with one fold per worker process. The matrix is
+# written once as .npy files (to /dev/shm when there is one) and every worker memory maps
+# them, so the folds share one copy of the data instead of getting a pickled copy each.
+# The folds are the ones of ModelTrainer.cross_validate, KFold with random_state=42.
+def share_matrix(X, y, directory):
+    X = sp.csr_matrix(X)
+    for name, array in [('data', X.data), ('indices', X.indices), ('indptr', X.indptr), ('labels', np.asarray(y))]:
+        np.save(os.path.join(directory, f'{name}.npy'), array)
+    return X.shape
+
+
+def open_matrix(directory, shape):
+    arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in ('data', 'indices', 'indptr', 'labels')}
+    return sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False), arrays['labels']
+
+
+def run_fold(directory, shape, fold, folds, max_iter):
+    #the worker finds its rows from the fold number, only the fold's rows are copied out of the map
+    X, y = open_matrix(directory, shape)
+    train_i, test_i = list(KFold(n_splits=folds, shuffle=True, random_state=42).split(np.zeros(shape[0])))[fold]
+
+    model = LinearSVC(max_iter=max_iter)
+    model.fit(X[train_i], y[train_i])
+    return test_i, predict(model, X[test_i])
+
+
+def cross_validate(X, y, folds=5, n_jobs=None, max_iter=10000):
+    #the out of fold prediction of every row, like cross_val_predict
+    n_jobs = n_jobs or min(folds, os.cpu_count())
+    y_pred = np.zeros(X.shape[0], dtype=np.asarray(y).dtype)
+
+    with tempfile.TemporaryDirectory(dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as directory:
+        shape = share_matrix(X, y, directory)
+        with ProcessPoolExecutor(n_jobs) as pool:
+            futures = [pool.submit(run_fold, directory, shape, fold, folds, max_iter) for fold in range(folds)]
+            for future in futures:
+                test_i, fold_pred = future.result()
+                y_pred[test_i] = fold_pred
+
+    return y_pred
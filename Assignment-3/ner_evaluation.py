@@ -0,0 +1,112 @@
+import numpy as np
+from NER import LABELS
+
+
+# Scores of the NER SVM computed from numpy arrays: the whole test matrix is classified with
+# one predict() per chunk, and the report, confusion matrix and entity span scores all come
+# from the label arrays.
+def predict(model, X, chunk_size=100000):
+    #chunk_size rows at a time, so the dense decision values of a huge matrix are never all in memory
+    if X.shape[0] <= chunk_size:
+        return np.asarray(model.predict(X))
+    return np.concatenate([model.predict(X[start:start + chunk_size]) for start in range(0, X.shape[0], chunk_size)])
+
+
+def confusion(y, y_pred, n_labels=len(LABELS)):
+    #confusion[true label, predicted label]
+    y = np.asarray(y, dtype=np.int64)
+    y_pred = np.asarray(y_pred, dtype=np.int64)
+    return np.bincount(y * n_labels + y_pred, minlength=n_labels * n_labels).reshape(n_labels, n_labels)
+
+
+def label_metrics(confusion_matrix):
+    #precision, recall, f1 and support of every label, 0 where they are undefined
+    tp = np.diag(confusion_matrix).astype(np.float64)
+    support = confusion_matrix.sum(1)
+    predicted = confusion_matrix.sum(0)
+    precision = np.divide(tp, predicted, out=np.zeros_like(tp), where=predicted > 0)
+    recall = np.divide(tp, support, out=np.zeros_like(tp), where=support > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(tp), where=precision + recall > 0)
+    return precision, recall, f1, support
+
+
+def spans(labels, lengths):
+    #the entity spans, runs of 1 labels which do not cross a sentence end, as start * n + end
+    labels = np.asarray(labels) != 0
+    n = len(labels)
+    boundaries = np.cumsum(np.asarray(lengths, dtype=np.int64))
+    sentence_start = np.zeros(n, dtype=bool)
+    sentence_start[boundaries[boundaries < n]] = True
+    sentence_start[:1] = True
+    sentence_end = np.roll(sentence_start, -1)
+    sentence_end[-1:] = True
+
+    previous = np.concatenate([[False], labels[:-1]])
+    following = np.concatenate([labels[1:], [False]])
+    starts = np.flatnonzero(labels & (sentence_start | ~previous))
+    ends = np.flatnonzero(labels & (sentence_end | ~following))
+    return starts * n + ends
+
+
+def span_scores(y, y_pred, lengths):
+    #exact match precision, recall and f1 of the spans. With only O and B/I labels, entities
+    #next to each other are one span
+    true_spans = spans(y, lengths)
+    predicted_spans = spans(y_pred, lengths)
+    correct = len(np.intersect1d(true_spans, predicted_spans, assume_unique=True))
+    precision = correct / len(predicted_spans) if len(predicted_spans) > 0 else 0.0
+    recall = correct / len(true_spans) if len(true_spans) > 0 else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    return {'precision': precision, 'recall': recall, 'f1': f1, 'true_spans': len(true_spans), 'predicted_spans': len(predicted_spans)}
+
+
+def scores(y, y_pred, lengths=None, labels=LABELS):
+    confusion_matrix = confusion(y, y_pred, len(labels))
+    precision, recall, f1, support = label_metrics(confusion_matrix)
+    weights = support / max(support.sum(), 1)
+
+    result = {
+        'confusion_matrix': confusion_matrix,
+        'labels': {label: {'precision': precision[i], 'recall': recall[i], 'f1': f1[i], 'support': int(support[i])} for i, label in enumerate(labels)},
+        'accuracy': np.trace(confusion_matrix) / max(confusion_matrix.sum(), 1),
+        'macro': {'precision': precision.mean(), 'recall': recall.mean(), 'f1': f1.mean()},
+        'weighted': {'precision': weights @ precision, 'recall': weights @ recall, 'f1': weights @ f1},
+    }
+    if lengths is not None:
+        result['spans'] = span_scores(y, y_pred, lengths)
+    return result
+
+
+def evaluate(model, X, y, lengths=None, chunk_size=100000):
+    y_pred = predict(model, X, chunk_size)
+    return scores(y, y_pred, lengths), y_pred
+
+
+def report(result):
+    #the layout of sklearn's classification_report, with the span scores after it
+    support = sum(metrics['support'] for metrics in result['labels'].values())
+    lines = [f'{"":>12} {"precision":>9} {"recall":>9} {"f1-score":>9} {"support":>9}', '']
+    for label, metrics in result['labels'].items():
+        lines.append(f'{label:>12} {metrics["precision"]:>9.2f} {metrics["recall"]:>9.2f} {metrics["f1"]:>9.2f} {metrics["support"]:>9}')
+    lines.append('')
+    lines.append(f'{"accuracy":>12} {"":>9} {"":>9} {result["accuracy"]:>9.2f} {support:>9}')
+    for average in ('macro', 'weighted'):
+        metrics = result[average]
+        lines.append(f'{average + " avg":>12} {metrics["precision"]:>9.2f} {metrics["recall"]:>9.2f} {metrics["f1"]:>9.2f} {support:>9}')
+
+    if 'spans' in result:
+        span_result = result['spans']
+        lines.append('')
+        lines.append(f'{"spans":>12} {span_result["precision"]:>9.2f} {span_result["recall"]:>9.2f} {span_result["f1"]:>9.2f} {span_result["true_spans"]:>9}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def plot_confusion_matrix(confusion_matrix, labels=LABELS):
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import ConfusionMatrixDisplay
+
+    disp = ConfusionMatrixDisplay(confusion_matrix=confusion_matrix, display_labels=labels)
+    disp.plot(cmap="Greys")
+    plt.title("Confusion Matrix")
+    plt.show()
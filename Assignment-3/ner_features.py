@@ -0,0 +1,112 @@
+import hashlib
+import os
+import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction import FeatureHasher
+from NER import FeatureExtractor, Predictor
+
+
+# The feature dicts of FeatureExtractor.extract_features hashed into a fixed number of columns,
+# instead of the columns of a fitted DictVectorizer. Nothing has to be fitted, so the corpus is
+# featurized in chunks by worker processes and only one chunk of dicts exists per worker at a
+# time. A saved model only needs n_features to be used again, not the vocabulary of a vectorizer.
+N_FEATURES = 2 ** 20
+
+# Change this whenever FeatureExtractor.extract_features makes different features. It is part
+# of the hash in the names of the cached feature matrices (see ner_trainer.py)
+FEATURE_VERSION = 1
+
+
+def feature_hasher(n_features=N_FEATURES):
+    #string features become 'name=value' with weight 1 like in DictVectorizer, booleans are 0 or 1
+    return FeatureHasher(n_features, input_type='dict', alternate_sign=False)
+
+
+def feature_config_hash(n_features=N_FEATURES):
+    return hashlib.sha1(repr((FEATURE_VERSION, n_features)).encode('utf-8')).hexdigest()[:16]
+
+
+def hash_chunk(sentences, n_features):
+    #sentences are dicts with tokens, pos_tags and ner_tags like the rows of the CoNLL-2003 dataset
+    features = []
+    labels = []
+    for sentence in sentences:
+        features.extend(FeatureExtractor.sentence_features(sentence['tokens'], sentence['pos_tags']))
+        labels.extend(sentence['ner_tags'])
+
+    #0 is O, the other tags are B/I
+    return feature_hasher(n_features).transform(features), (np.array(labels, dtype=np.int64) != 0).astype(np.int8)
+
+
+def set_stop_words(stop_words):
+    #worker initializer, the stop words are read once by the parent
+    FeatureExtractor.stop_words = stop_words
+
+
+class HashingFeaturizer:
+
+    # chunk_size sentences are featurized at a time, at most two chunks per worker are in
+    # flight. n_jobs=1 featurizes in this process.
+    def __init__(self, n_features=N_FEATURES, chunk_size=1000, n_jobs=None):
+        self.n_features = n_features
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs or os.cpu_count()
+
+    def hasher(self):
+        #the vectorizer for Predictor, it has the same transform(list of dicts)
+        return feature_hasher(self.n_features)
+
+    def chunks(self, dataset):
+        #yields a (CSR matrix, labels) pair for every chunk_size sentences, in the order of the dataset
+        batches = self.batches(dataset)
+        if self.n_jobs == 1:
+            for batch in batches:
+                yield hash_chunk(batch, self.n_features)
+            return
+
+        pending = deque()
+        with ProcessPoolExecutor(self.n_jobs, initializer=set_stop_words, initargs=(FeatureExtractor.load_stop_words(),)) as pool:
+            for batch in batches:
+                pending.append(pool.submit(hash_chunk, batch, self.n_features))
+                if len(pending) >= 2 * self.n_jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def batches(self, dataset):
+        #only the columns which are used are sent to the workers
+        batch = []
+        for item in dataset:
+            batch.append({'tokens': item['tokens'], 'pos_tags': item['pos_tags'], 'ner_tags': item['ner_tags']})
+            if len(batch) == self.chunk_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def transform(self, dataset):
+        #the whole dataset as one CSR matrix and an array of 0 / 1 labels
+        matrices = []
+        labels = []
+        for X, y in self.chunks(dataset):
+            matrices.append(X)
+            labels.append(y)
+
+        if not matrices:
+            return sp.csr_matrix((0, self.n_features)), np.zeros(0, dtype=np.int8)
+        return sp.vstack(matrices, format='csr'), np.concatenate(labels)
+
+
+def save_hashed_model(model, n_features, filename='svm_hashed_model.pkl'):
+    with open(filename, 'wb') as out:
+        pickle.dump({'model': model, 'n_features': n_features}, out)
+
+
+def load_hashed_model(filename='svm_hashed_model.pkl', batch_size=256):
+    #a Predictor with the saved model and the hasher it was trained with
+    with open(filename, 'rb') as inp:
+        saved = pickle.load(inp)
+    return Predictor(saved['model'], feature_hasher(saved['n_features']), batch_size)
@@ -0,0 +1,115 @@
+import argparse
+import os
+import numpy as np
+import scipy.sparse as sp
+from sklearn.svm import LinearSVC
+from NER import DataLoader, Predictor
+import ner_cv
+from ner_evaluation import evaluate, report, scores
+from ner_features import HashingFeaturizer, feature_config_hash, feature_hasher, save_hashed_model
+
+
+# Trains the NER SVM on hashed features (see ner_features.py). Every split of the corpus is
+# featurized once into a CSR matrix, which fit, cross_validate and evaluate all reuse.
+# With cache_dir the matrices are also saved as .npz files and read back by the next run.
+# The file names have the feature_config_hash() of the featurizer in them, so matrices made
+# with other features or another n_features are not read, they are made again.
+class NERTrainer:
+
+    def __init__(self, featurizer=None, cache_dir=None):
+        self.featurizer = featurizer or HashingFeaturizer()
+        self.cache_dir = cache_dir
+        self.model = LinearSVC(max_iter=10000)
+        #split name -> (X, y), and the number of tokens of every sentence for the span scores
+        self.matrices = {}
+        self.sentence_lengths = {}
+
+    def vectorize(self, name, dataset):
+        if name in self.matrices:
+            return self.matrices[name]
+
+        filename = self.cache_file(name)
+        if filename is not None and os.path.exists(filename):
+            X, y, self.sentence_lengths[name] = load_matrix(filename)
+            self.matrices[name] = X, y
+        else:
+            self.matrices[name] = self.featurizer.transform(dataset)
+            self.sentence_lengths[name] = np.array([len(item['tokens']) for item in dataset], dtype=np.int64)
+            if filename is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                save_matrix(filename, *self.matrices[name], self.sentence_lengths[name])
+
+        return self.matrices[name]
+
+    def cache_file(self, name):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f'{name}_{feature_config_hash(self.featurizer.n_features)}.npz')
+
+    def fit(self, name='train'):
+        X, y = self.matrices[name]
+        self.model.fit(X, y)
+
+    def cross_validate(self, name='train', folds=5, n_jobs=None):
+        #the folds are fitted in parallel over one shared copy of the matrix, see ner_cv.py
+        X, y = self.matrices[name]
+        y_pred = ner_cv.cross_validate(X, y, folds, n_jobs)
+
+        print(f"Classification Report ({folds}-Fold Cross-Validation):")
+        print(report(scores(y, y_pred, self.sentence_lengths[name])))
+        return y_pred
+
+    def evaluate(self, name='test'):
+        #see ner_evaluation.py, the whole split is scored with one predict() per chunk
+        X, y = self.matrices[name]
+        result, y_pred = evaluate(self.model, X, y, self.sentence_lengths[name])
+
+        print("Classification Report:")
+        print(report(result))
+        return result, y_pred
+
+    def predictor(self, batch_size=256):
+        return Predictor(self.model, feature_hasher(self.featurizer.n_features), batch_size)
+
+    def save(self, filename='svm_hashed_model.pkl'):
+        save_hashed_model(self.model, self.featurizer.n_features, filename)
+
+
+def save_matrix(filename, X, y, sentence_lengths):
+    #the arrays of the CSR matrix, the labels and the sentence lengths in one file
+    np.savez(filename, data=X.data, indices=X.indices, indptr=X.indptr, shape=np.array(X.shape), labels=y, lengths=sentence_lengths)
+
+
+def load_matrix(filename):
+    with np.load(filename) as arrays:
+        X = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(arrays['shape']))
+        return X, arrays['labels'], arrays['lengths']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the NER SVM on hashed CoNLL-2003 features')
+    parser.add_argument('--cache-dir', default='ner_cache', help='directory of the .npz feature matrices, "" for none')
+    parser.add_argument('--folds', type=int, default=0, help='cross validate on the train split first, 0 for no cross validation')
+    parser.add_argument('--jobs', type=int, default=None, help='featurizer worker processes')
+    parser.add_argument('--cv-jobs', type=int, default=None, help='cross validation worker processes, one per fold by default')
+    parser.add_argument('--model', default='svm_hashed_model.pkl')
+    args = parser.parse_args()
+
+    trainer = NERTrainer(HashingFeaturizer(n_jobs=args.jobs), args.cache_dir or None)
+    cache_files = [trainer.cache_file(name) for name in ('train', 'test')]
+    if all(filename is not None and os.path.exists(filename) for filename in cache_files):
+        train_data = test_data = None
+    else:
+        train_data, test_data, _ = DataLoader.load_conll2003()
+    trainer.vectorize('train', train_data)
+    trainer.vectorize('test', test_data)
+
+    if args.folds:
+        trainer.cross_validate('train', args.folds, args.cv_jobs)
+    trainer.fit('train')
+    trainer.evaluate('test')
+    trainer.save(args.model)
+
+
+if __name__ == '__main__':
+    main()